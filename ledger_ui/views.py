@@ -166,12 +166,16 @@ def submit(request):
     ledger_errors = False
 
     try:
-        accounts = journal.accounts
-        currencies = journal.currencies
-        payees = journal.payees
+        # The sets below are read straight from the journal, only
+        # ledger-cli actually validates it.
+        journal.accounts()
     except journal.LedgerCliError as e:
         accounts = currencies = payees = []
         ledger_errors = e.__cause__
+    else:
+        accounts = journal.account_set
+        currencies = journal.currency_set
+        payees = journal.payee_set
 
     if request.method == "POST":
         form = SubmitForm(
@@ -353,8 +357,8 @@ class RuleViewBase(CreateView):
         kwargs = super().get_form_kwargs()
         ledger_path = settings.LEDGER_PATH
         journal = ledger_api.Journal(ledger_path)
-        kwargs["accounts"] = journal.accounts
-        kwargs["payees"] = journal.payees
+        kwargs["accounts"] = journal.account_set
+        kwargs["payees"] = journal.payee_set
         kwargs["user"] = self.request.user
         return kwargs
 
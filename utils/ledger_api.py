@@ -1,10 +1,36 @@
 #!/usr/bin/env python3
-import csv
 import io
+import os
 import re
 import subprocess
 from collections import namedtuple
 
+_ENTRY_HEADER_RE = re.compile(r"(\d{4}-\d{2}-\d{2}|\d{4}/\d{2}/\d{2})(?: [!*])?\s+(.*)")
+_NOTE_RE = re.compile(r"\s*;\s*(.*)")
+# An amount optionally followed by whitespace and its currency,
+# e.g. "19.99 PLN".
+_AMOUNT_RE = re.compile(r"([-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)(?:\s+(.*))?")
+# Entries are separated by lines containing only whitespace.
+_ENTRY_SPLIT_RE = re.compile(rb"\n\s*\n")
+_INDENT_RE = re.compile(r"\s*\n\s*")
+
+# Used by Journal._parse() to pick the payees, accounts and currencies
+# straight from the journal text, without calling ledger-cli.
+_TRANSACTION_RE = re.compile(
+    r"\d{4}[-/]\d{1,2}[-/]\d{1,2}(?:=\S+)?"  # date[=aux_date]
+    r"(?:\s+[*!])?"  # cleared/pending mark
+    r"(?:\s+\([^)]*\))?"  # code
+    r"(?:\s+(.*?))?"  # payee
+    r"(?:(?:\s{2,}|\t);.*)?"  # note
+)
+_POSTING_RE = re.compile(
+    r"(?:[*!]\s*)?"  # cleared/pending mark
+    r"(.+?)"  # account
+    r"(?:(?:\s{2,}|\t)\s*([^;]*?))?"  # amount
+    r"\s*(?:;.*)?"  # note
+)
+_COMMODITY_RE = re.compile(r'"[^"]+"|[^-\s\d.,+*/()"=@;]+')
+
 EntryAccount = namedtuple(
     "EntryAccount",
     [
@@ -81,47 +107,99 @@ class Entry:
         Expenses:Food                              $5.00
         Assets:Loans:John                          $5.00
         Liabilities:Credit Card
+
+    The amount and the currency have to be separated by whitespace,
+    malformed amounts are rejected.
+
+    >>> Entry(
+    ...    payee="Biedronka",
+    ...    accounts=[("Expenses:Food", "1e3 PLN"), ("Expenses:Food", "5")],
+    ...    date="2019-02-17",
+    ... ).accounts  # doctest: +NORMALIZE_WHITESPACE
+    [EntryAccount(name='Expenses:Food', amount='1000.00', currency='PLN'),
+     EntryAccount(name='Expenses:Food', amount='5.00', currency='')]
+
+    >>> Entry(
+    ...    payee="Biedronka",
+    ...    accounts=[("Expenses:Food", "1.000.00 PLN")],
+    ...    date="2019-02-17",
+    ... )
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid amount: '1.000.00 PLN'
+
+    >>> Entry(
+    ...    payee="Biedronka",
+    ...    accounts=[("Expenses:Food", "10,50 PLN")],
+    ...    date="2019-02-17",
+    ... )
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid amount: '10,50 PLN'
     """
 
+    __slots__ = ("payee", "date", "note", "accounts", "_cached_str", "_curmap")
+
+    _TPL_NO_AMOUNT = "    {account}"
+    _TPL_LEFT = "    {account:<34s}  {amount:>12}"
+    _TPL_RIGHT = "    {account:<34s}  {amount:>12} {currency}"
+
     def __init__(self, payee, date, accounts, note=None):
         self.payee = payee
         self.date = date
         self.note = note
+        # Entries are never modified after being created so it's safe
+        # to render them only once.
+        self._cached_str = None
 
         self.accounts = []
         for account in accounts:
-            try:
+            n = len(account)
+            if n == 3:
                 # We got either the 3-argument form...
                 name, amount, currency = account
-            except ValueError:
-                # ...or the 2-argument form with currency merged with amount...
-                try:
-                    name, amount = account
-                except ValueError:
-                    # ...or the single-argument form with no amount or currency.
-                    (name,) = account
-                    amount = None
-                    currency = None
-                else:
-                    # We definitely got the 2-argument form, let's
-                    # split it into amount and currency or just
-                    # amount.
-                    amount, _, currency = amount.partition(" ")
-            finally:
-                # amount may be None if we got the 1-argument form.
-                if amount is not None:
-                    amount = "{:.2f}".format(float(amount))
-                else:
-                    # Avoid storing a currency without a value, it
-                    # doesn't make sense and leads to weird bugs.
-                    currency = None
-            self.accounts.append(
-                EntryAccount(
-                    name=name,
-                    amount=amount,
-                    currency=currency,
-                )
-            )
+            elif n == 2:
+                # ...or the 2-argument form with currency merged with
+                # amount, let's split it into amount and currency or
+                # just amount...
+                name, amount = account
+                match = _AMOUNT_RE.fullmatch(amount)
+                if match is None:
+                    raise ValueError("Invalid amount: {!r}".format(amount))
+                amount, currency = match.group(1), match.group(2) or ""
+            else:
+                # ...or the single-argument form with no amount or currency.
+                (name,) = account
+                amount = None
+
+            # amount may be None if we got the 1-argument form.
+            if amount is not None:
+                amount = f"{float(amount):.2f}"
+            else:
+                # Avoid storing a currency without a value, it
+                # doesn't make sense and leads to weird bugs.
+                currency = None
+            self.accounts.append(EntryAccount(name, amount, currency))
+
+        self._curmap = self._map_currencies()
+
+    def __setstate__(self, state):
+        # Entries pickled (in the Undo table) before __slots__ was
+        # added have a plain __dict__ for their state.
+        if isinstance(state, tuple):
+            _, state = state
+        self._cached_str = None
+        for name, value in state.items():
+            setattr(self, name, value)
+        if "_curmap" not in state:
+            self._curmap = self._map_currencies()
+
+    def _map_currencies(self):
+        return {
+            account.currency: self.normalize_currency(account.currency)
+            for account in self.accounts
+            if account.amount is not None
+        }
 
     currency_conversions = {
         "USD": {
@@ -150,35 +228,33 @@ class Entry:
             }
 
     def __str__(self):
-        output = [""]
-        output.append("{date} {payee}".format(**vars(self)))
+        if self._cached_str is None:
+            self._cached_str = "\n".join(self._lines())
+        return self._cached_str
+
+    def _lines(self):
+        yield ""
+        yield f"{self.date} {self.payee}"
         if self.note:
             for line in self.note.splitlines():
-                output.append("    ; {note}".format(note=line))
+                yield f"    ; {line}"
         for account in self.accounts:
-            currency = self.normalize_currency(account.currency)
             if account.amount is None:
-                template = "    {account}"
+                yield self._TPL_NO_AMOUNT.format(account=account.name)
+                continue
+
+            currency = self._curmap[account.currency]
+            if currency["position"] == "left":
+                yield self._TPL_LEFT.format(
+                    account=account.name,
+                    amount=f"{currency['symbol']}{account.amount}",
+                )
             else:
-                if currency["position"] == "left":
-                    account = account._replace(
-                        amount="{currency}{amount}".format(
-                            currency=currency["symbol"],
-                            amount=account.amount,
-                        ),
-                    )
-                    template = "    {account:<34s}  {amount:>12}"
-                else:
-                    template = "    {account:<34s}  {amount:>12} {currency}"
-
-            output.append(
-                template.format(
+                yield self._TPL_RIGHT.format(
                     account=account.name,
-                    currency=currency["symbol"],
                     amount=account.amount,
+                    currency=currency["symbol"],
                 )
-            )
-        return "\n".join(output)
 
 
 class Journal:
@@ -202,79 +278,224 @@ class Journal:
     def __init__(self, ledger_path, last_data=None):
         self.path = ledger_path
         self.last_data = last_data
-        self.accounts = set()
-        self.payees = set()
-        self.currencies = set()
+        # ledger-cli output by command, see _cached_call().
+        self._call_cache = {}
+        self.account_set = set()
+        self.payee_set = set()
+        self.currency_set = set()
         self._parse()
 
+    @property
+    def last_data(self):
+        return self._last_data
+
+    @last_data.setter
+    def last_data(self, last_data):
+        self._last_data = last_data
+        # Rendered by _is_last_entry() when first needed.
+        self._stored_entry = None
+
     def can_revert(self):
         if self.last_data is None:
             return False
 
-        with open(self.path, "r") as ledger_file:
-            current_end = ledger_file.seek(0, 2)
-            if current_end != self.last_data.new_position:
-                return False
-
-            ledger_file.seek(self.last_data.old_position)
-            stored_entry = str(self.last_data.last_entry)
-            actual_entry = ledger_file.read().rstrip()
-            if stored_entry != actual_entry:
-                return False
+        # Most likely something got appended since, no need to even
+        # open the file then.
+        if os.stat(self.path).st_size != self.last_data.new_position:
+            return False
 
-        return True
+        with open(self.path, "rb") as ledger_file:
+            return self._is_last_entry(ledger_file)
 
     def revert(self):
         if self.last_data is None:
             raise Journal.CannotRevert()
 
-        with open(self.path, "a+") as ledger_file:
-            if self.last_data.new_position != ledger_file.tell():
-                raise Journal.CannotRevert()
-
-            ledger_file.seek(self.last_data.old_position)
-            if ledger_file.read().rstrip() != str(self.last_data.last_entry):
+        with open(self.path, "rb+") as ledger_file:
+            if not self._is_last_entry(ledger_file):
                 raise Journal.CannotRevert()
 
             ledger_file.truncate(self.last_data.old_position)
+        self._call_cache.clear()
+
+    def _is_last_entry(self, ledger_file):
+        # last_data.last_entry may be unpickled on each access, render
+        # it only once for both can_revert() and revert().
+        if self._stored_entry is None:
+            self._stored_entry = str(self.last_data.last_entry).encode("utf-8")
+
+        # append() writes the entry followed by a newline.
+        entry_size = len(self._stored_entry) + 1
+        if self.last_data.new_position - self.last_data.old_position > entry_size:
+            return False
+
+        current_end = ledger_file.seek(0, 2)
+        if current_end != self.last_data.new_position:
+            return False
+
+        ledger_file.seek(self.last_data.old_position)
+        actual_entry = ledger_file.read(entry_size).rstrip()
+        return actual_entry == self._stored_entry
 
     def append(self, entry):
-        with open(self.path, "a") as ledger_file:
-            print(entry, file=ledger_file)
+        return self.append_many([entry])
+
+    def append_many(self, entries, sync=False):
+        """Append all the entries with a single write.
+
+        Returns the file positions before and after the write, as
+        expected by LastData.  With sync=True the data is also
+        fsync'ed to the disk before returning.
+
+        >>> import tempfile
+        >>> tmp = tempfile.TemporaryDirectory()
+        >>> path = os.path.join(tmp.name, "journal.ledger")
+        >>> with open(path, "w", encoding="utf-8") as ledger_file:
+        ...     _ = ledger_file.write("2019-02-14 Opening Balances\\n")
+        >>> with open(path, "rb") as ledger_file:
+        ...     original = ledger_file.read()
+        >>> entry = Entry(
+        ...    payee="Żabka",
+        ...    accounts=[("Expenses:Food", "5 PLN"), ("Assets:Wallet",)],
+        ...    date="2019-02-15",
+        ... )
+
+        >>> old, new = Journal(path).append(entry)
+        >>> old == len(original), new == os.path.getsize(path)
+        (True, True)
+        >>> journal = Journal(path, Journal.LastData(entry, old, new))
+        >>> journal.can_revert()
+        True
+        >>> journal.revert()
+        >>> with open(path, "rb") as ledger_file:
+        ...     ledger_file.read() == original
+        True
+
+        >>> other = Entry(
+        ...    payee="Lidl",
+        ...    accounts=[("Assets:Wallet",)],
+        ...    date="2019-02-16",
+        ... )
+        >>> old, new = Journal(path).append_many([entry, other], sync=True)
+        >>> with open(path, encoding="utf-8") as ledger_file:
+        ...     _ = ledger_file.seek(old)
+        ...     ledger_file.read() == "{}\\n{}\\n".format(entry, other)
+        True
+        >>> tmp.cleanup()
+        """
+        with open(self.path, "a", encoding="utf-8") as ledger_file:
+            old_position = ledger_file.tell()
+            ledger_file.write("".join("{}\n".format(entry) for entry in entries))
+            new_position = ledger_file.tell()
+            if sync:
+                ledger_file.flush()
+                os.fsync(ledger_file.fileno())
+        self._call_cache.clear()
+        return old_position, new_position
 
     def accounts(self):
-        return self._call("accounts")
+        return self._cached_call("accounts")
 
     def payees(self):
-        return self._call("payees")
+        return self._cached_call("payees")
 
     def currencies(self):
-        return self._call("commodities")
+        return self._cached_call("commodities")
 
-    def _csv(self, *args):
-        return io.StringIO("\n".join(self._call("csv", *args)))
+    def _cached_call(self, command):
+        # Spawning ledger-cli is slow, run each of these only once
+        # until the journal is modified by append() or revert().
+        if command not in self._call_cache:
+            self._call_cache[command] = self._call(command).splitlines()
+        return self._call_cache[command]
+
+    def csv(self, *args):
+        return io.StringIO(self._call("csv", *args))
 
     def _parse(self):
-        csv_file = self._call("csv")
-        columns = [
-            "date",
-            "code",
-            "payee",
-            "account",
-            "currency",
-            "amount",
-            "reconciled",
-            "note",
-        ]
-        # csv.DictReader can read from "any object that supports the iterator protocol and returns a
-        # string each time its __next__() method is called."  A string is not such an object, but an
-        # open text-file handle is.
-        fake_csv_file = io.StringIO(csv_file)
-        reader = csv.DictReader(fake_csv_file, fieldnames=columns)
-        for row in reader:
-            self.payees.add(row["payee"])
-            self.currencies.add(row["currency"])
-            self.accounts.add(row["account"])
+        """Collect the payees, accounts and currencies of the journal.
+
+        A single pass over the journal, collecting the same sets that
+        `ledger csv` would report without spawning ledger-cli.
+
+        >>> import tempfile
+        >>> tmp = tempfile.TemporaryDirectory()
+        >>> path = os.path.join(tmp.name, "journal.ledger")
+        >>> with open(path, "w", encoding="utf-8") as ledger_file:
+        ...     _ = ledger_file.write('''
+        ... account Ignored:Directive
+        ...
+        ... = expr true
+        ...     (Ignored:Automated)  1
+        ...
+        ... ~ Monthly
+        ...     Ignored:Periodic  $10
+        ...
+        ... 2019/02/15 * (42) Burger King  ; :food:
+        ...     ; A note.
+        ...     Expenses:Food          19.99 PLN @ $0.25
+        ...     (Budget:Food)          -19.99 PLN
+        ...     [Assets:Reserved]      -10
+        ...     Liabilities:Credit Card
+        ...
+        ... 2019-02-16 Bank
+        ...     Assets:Bank            $5 = $105
+        ...     Assets:Cash            = 200 USD
+        ...
+        ... 2019-02-17
+        ...     Assets:Wallet          -1 EUR
+        ...     Equity:Adjustments
+        ... ''')
+        >>> journal = Journal(path)
+        >>> sorted(journal.payee_set)
+        ['Bank', 'Burger King']
+        >>> sorted(journal.account_set)  # doctest: +NORMALIZE_WHITESPACE
+        ['(Budget:Food)', 'Assets:Bank', 'Assets:Cash', 'Assets:Wallet',
+         'Equity:Adjustments', 'Expenses:Food', 'Liabilities:Credit Card',
+         '[Assets:Reserved]']
+        >>> sorted(journal.currency_set)
+        ['', '$', 'EUR', 'PLN', 'USD']
+        >>> tmp.cleanup()
+
+        Unlike ledger-cli, `include`d files are not followed and a
+        transaction without a payee only contributes its postings.
+        """
+        add_payee = self.payee_set.add
+        add_account = self.account_set.add
+        add_currency = self.currency_set.add
+        in_transaction = False
+        # A larger buffer means fewer read() calls on big journals.
+        with open(self.path, "r", encoding="utf-8", buffering=1 << 20) as ledger_file:
+            for line in ledger_file:
+                line = line.rstrip()
+                if not line:
+                    in_transaction = False
+                elif not line[0].isspace():
+                    # Anything that is not a regular transaction
+                    # (directives, automated or periodic transactions,
+                    # comments) is skipped along with its postings.
+                    match = _TRANSACTION_RE.fullmatch(line)
+                    in_transaction = match is not None
+                    if in_transaction and match.group(1):
+                        add_payee(match.group(1))
+                elif in_transaction:
+                    line = line.lstrip()
+                    if line[0] == ";":
+                        continue
+                    account, amount = _POSTING_RE.fullmatch(line).groups()
+                    add_account(account)
+                    if amount:
+                        # The cost and the balance assertion aren't part
+                        # of the posting's own amount, but a balance
+                        # assignment (with no amount) gives its currency.
+                        amount, _, balance = amount.partition("@")[0].partition("=")
+                        amount = amount.strip() or balance.strip()
+                    if amount:
+                        # The elided amounts are implicitly in one of
+                        # the transaction's other currencies, only a
+                        # commodity-less amount adds the empty one.
+                        commodity = _COMMODITY_RE.search(amount)
+                        add_currency(commodity.group(0) if commodity else "")
 
     def _call(self, *args):
         try:
@@ -289,22 +510,13 @@ class Journal:
         return output
 
     def __iter__(self):
-        date_regexp = r"\d{4}-\d{2}-\d{2}|\d{4}/\d{2}/\d{2}"
-
-        def prepare_entry(entry_lines):
-            match = re.match(
-                "({date}){cleared}\s+({payee})".format(
-                    date=date_regexp, cleared=r"(?: [!*])?", payee=r".*"
-                ),
-                entry_lines[0],
-            )
+        def prepare_entry(body):
+            entry_lines = body.split("\n", 2)
+            match = _ENTRY_HEADER_RE.match(entry_lines[0])
             date = match.group(1)
             payee = match.group(2)
 
-            match = re.fullmatch(
-                "\s*;\s*(.*)",
-                entry_lines[1],
-            )
+            match = _NOTE_RE.fullmatch(entry_lines[1])
             if match:
                 note = match.group(1)
             else:
@@ -313,23 +525,20 @@ class Journal:
                 note = ""
 
             return {
-                "body": "\n".join(entry_lines),
+                "body": body,
                 "date": date,
                 "payee": payee,
                 "note": note,
             }
 
-        with open(self.path, "r") as ledger_file:
-            entry = []
-            for line in map(str.strip, ledger_file):
-                # If there's a line, it's part of an entry
-                if line:
-                    entry.append(line)
-                # If only whitespace is found and there are lines in entry,
-                # then the entry has ended
-                elif entry:
-                    yield prepare_entry(entry)
-                    entry = []
+        with open(self.path, "rb") as ledger_file:
+            data = ledger_file.read()
+
+        for chunk in _ENTRY_SPLIT_RE.split(data):
+            chunk = chunk.strip()
+            if chunk:
+                # Strip the indentation of every line in one go.
+                yield prepare_entry(_INDENT_RE.sub("\n", chunk.decode("utf-8")))
 
 
 if __name__ == "__main__":